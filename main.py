@@ -2,17 +2,46 @@
 # (Versi lengkap dengan CORS untuk web)
 
 import os
+import json
+import math
+import queue
+import atexit
 import asyncio
-from typing import List
+import time
+import hashlib
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, AsyncIterator, Dict, Iterable, List, Literal, Optional, Tuple
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-import google.generativeai as genai
-from openai import OpenAI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ConfigDict
+import httpx
+from google import genai
+from google.genai import types as genai_types
+from openai import AsyncOpenAI
 
 # === TAMBAHKAN IMPORT INI ===
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 # =============================
 
+# --- 0. Logging ---
+# Handler hanya menaruh record ke antrean; format dan tulis ke stderr dilakukan
+# thread QueueListener, sehingga coroutine tidak tertahan oleh IO stdout.
+logger = logging.getLogger("aggregator")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue: queue.Queue = queue.Queue(-1)
+logger.addHandler(QueueHandler(_log_queue))
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 # --- 1. Konfigurasi Kunci API ---
 # Pastikan Anda mengatur ini di terminal Anda
 # (cth: export GEMINI_API_KEY=...)
@@ -20,17 +49,96 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
 if not GEMINI_API_KEY or not OPENAI_API_KEY:
-    print("Peringatan: Pastikan GEMINI_API_KEY dan OPENAI_API_KEY sudah diatur.")
+    logger.warning("Peringatan: Pastikan GEMINI_API_KEY dan OPENAI_API_KEY sudah diatur.")
 
 # --- 2. Inisialisasi Klien API ---
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-    gemini_model = genai.GenerativeModel('gemini-pro')
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
-except Exception as e:
-    print(f"Peringatan: Gagal inisialisasi klien API. {e}")
+# Klien async native: tidak ada thread per permintaan, dan koneksi HTTP
+# (TCP + TLS) dipakai ulang lewat satu connection pool bersama.
+GEMINI_MODEL = "gemini-pro"
+
+# Batas panggilan bersamaan per penyedia (sesuaikan dengan kuota RPM akun).
+# Lonjakan trafik mengantre di sini, bukan berakhir dengan 429 + retry backoff.
+# Nilai env adalah anggaran untuk seluruh server; semaphore berlaku per proses,
+# jadi anggaran dibagi rata ke WEB_CONCURRENCY worker uvicorn. WEB_CONCURRENCY
+# harus sama dengan jumlah worker sebenarnya: `uvicorn --workers N` tanpa env ini
+# membuat setiap worker memakai seluruh anggaran (lihat bagian 13).
+# Setiap worker mendapat minimal 1 slot, jadi jika worker lebih banyak daripada
+# anggaran, total batasnya menjadi WEB_CONCURRENCY (ada peringatan di log).
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
+def _per_worker(name: str, budget: int) -> int:
+    if budget < WEB_CONCURRENCY:
+        logger.warning(
+            "Peringatan: %s=%d lebih kecil dari WEB_CONCURRENCY=%d; total batas menjadi %d.",
+            name, budget, WEB_CONCURRENCY, WEB_CONCURRENCY,
+        )
+    return max(1, budget // WEB_CONCURRENCY)
+
+OPENAI_SEM = asyncio.Semaphore(
+    _per_worker("OPENAI_MAX_CONCURRENCY", int(os.environ.get("OPENAI_MAX_CONCURRENCY", "50")))
+)
+GEMINI_SEM = asyncio.Semaphore(
+    _per_worker("GEMINI_MAX_CONCURRENCY", int(os.environ.get("GEMINI_MAX_CONCURRENCY", "30")))
+)
+
+# Klien dibuat lewat factory ber-`lru_cache`: tidak ada efek samping saat import,
+# setiap proses worker uvicorn membuatnya tepat sekali (di lifespan), dan semua
+# handler memakai instance yang sama.
+@lru_cache(maxsize=None)
+def get_http_client() -> httpx.AsyncClient:
+    # HTTP/2 memultipleks banyak permintaan dalam satu koneksi; keep-alive panjang
+    # menghindari DNS lookup + TLS handshake ulang di antara lonjakan trafik.
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2, # Hanya mengulang kegagalan koneksi, bukan respons HTTP
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=50,
+                keepalive_expiry=300,
+            ),
+        ),
+        timeout=30,
+    )
 
-app = FastAPI(title="AI Aggregator Konsensus API")
+@lru_cache(maxsize=None)
+def get_gemini_client() -> genai.Client:
+    # Tanpa httpx_async_client, google-genai membuat transport sendiri dan
+    # tidak ikut memakai pool HTTP/2 bersama di atas
+    return genai.Client(
+        api_key=GEMINI_API_KEY,
+        http_options=genai_types.HttpOptions(
+            httpx_async_client=get_http_client(),
+            timeout=30_000, # Milidetik; tanpa ini timeout pool ditimpa None per request
+        ),
+    )
+
+@lru_cache(maxsize=None)
+def get_openai_client() -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=get_http_client())
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Inisialisasi sekali per proses worker, lalu dibersihkan saat shutdown."""
+    # Klien dibuat di awal agar kunci API yang salah langsung terlihat di log
+    try:
+        get_gemini_client()
+        get_openai_client()
+    except Exception as e:
+        logger.warning("Peringatan: Gagal inisialisasi klien API. %s", e)
+    cache.open(REDIS_URL, DISK_CACHE_DIR)
+    semantic_cache.load()
+    build_schemas()
+    yield
+    semantic_cache.save()
+    await cache.close()
+    await get_http_client().aclose()
+    # Semua klien memegang pool di atas, jadi ikut dibuang agar siklus berikutnya membuat ulang
+    get_http_client.cache_clear()
+    get_gemini_client.cache_clear()
+    get_openai_client.cache_clear()
+
+app = FastAPI(title="AI Aggregator Konsensus API", lifespan=lifespan)
 
 # === 3. Pengaturan CORS (PENTING UNTUK WEB) ===
 # Ini mengizinkan browser (dari 'null' / file://) untuk mengakses API Anda
@@ -40,6 +148,11 @@ origins = [
     "http://localhost",
 ]
 
+# Kompres respons JSON/teks di atas 500 byte. Stream SSE (text/event-stream)
+# dikecualikan oleh Starlette (>= 0.46, lihat requirements.txt) agar token
+# tidak tertahan di buffer gzip.
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -50,99 +163,695 @@ app.add_middleware(
 # =================================================
 
 # --- 4. Definisi Model Data (Pydantic) ---
+# Model beku (frozen) tanpa field tambahan: validasi Pydantic v2 tetap di jalur
+# inti Rust, dan respons di-serialisasi langsung lewat model_dump().
 class PromptRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
     prompt: str
     models: List[str] = ["gemini", "gpt"]
+    no_cache: bool = False # Lewati cache semantik untuk permintaan ini
+    # "fastest": kembalikan respons sukses pertama, tanpa menunggu model lain/konsensus
+    mode: Literal["fastest", "consensus"] = "consensus"
 
 class ModelResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
     model_name: str
     response: str
 
-# --- 5. Fungsi Helper Pemanggil LLM ---
+class StatusResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    status: str
+
+class CacheStats(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    backend: str
+    hits: int
+    misses: int
+    hit_rate: float
+
+# --- 5. Cache Respons LLM (exact-match) ---
+# Prompt yang sama persis untuk model yang sama tidak perlu dikirim ulang ke API.
+# Dua tingkat: LRU di memori sebagai lapisan depan, lalu penyimpanan belakang
+# yang bertahan setelah restart/reload: Redis jika REDIS_URL diatur (butuh
+# `pip install redis`), selain itu diskcache di LLM_CACHE_DIR.
+REDIS_URL = os.environ.get("REDIS_URL")
+CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", "3600")) # Berlaku untuk semua tingkat
+CACHE_MEMORY_SIZE = int(os.environ.get("LLM_CACHE_MEMORY_SIZE", "1024"))
+DISK_CACHE_DIR = os.environ.get("LLM_CACHE_DIR", "./llm_cache")
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+class LLMCache:
+    """
+    Cache respons LLM: LRU memori di depan, Redis atau diskcache di belakang.
+    Penyimpanan belakang baru dipasang lewat `open()` (dipanggil dari lifespan),
+    sehingga import modul tidak membuka koneksi atau membuat direktori.
+    Kegagalan penyimpanan belakang hanya dicatat dan dianggap miss.
+    """
+
+    def __init__(self):
+        self._store: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._redis = None
+        self._disk = None
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, redis_url: Optional[str] = None, disk_dir: Optional[str] = None) -> None:
+        if redis_url:
+            try:
+                import redis.asyncio as aioredis
+                self._redis = aioredis.from_url(redis_url)
+            except Exception as e:
+                logger.warning("Peringatan: Redis tidak tersedia, memakai cache disk. %s", e)
+        if self._redis is None and disk_dir and diskcache is not None:
+            try:
+                self._disk = diskcache.Cache(disk_dir, size_limit=2**30)
+            except Exception as e:
+                logger.warning("Peringatan: Cache disk tidak tersedia, memakai cache memori. %s", e)
+
+    async def close(self) -> None:
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+    @staticmethod
+    def make_key(model_name: str, prompt: str) -> str:
+        payload = json.dumps({"model": model_name, "prompt": prompt}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _memory_get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._store.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._store[key]
+            return None
+        self._store.move_to_end(key)
+        return value
+
+    def _memory_set(self, key: str, value: Dict[str, Any], ttl: float) -> None:
+        self._store[key] = (time.monotonic() + ttl, value)
+        self._store.move_to_end(key)
+        while len(self._store) > CACHE_MEMORY_SIZE:
+            self._store.popitem(last=False)
+
+    async def _backing_get(self, key: str) -> Tuple[Optional[Dict[str, Any]], float]:
+        """Nilai dari penyimpanan belakang beserta sisa TTL-nya (detik)."""
+        if self._redis is not None:
+            async with self._redis.pipeline() as pipe:
+                raw, remaining = await pipe.get(key).ttl(key).execute()
+            return (json.loads(raw) if raw is not None else None), remaining
+        if self._disk is not None:
+            # diskcache memakai SQLite (IO blocking), jadi dijalankan di thread
+            value, expire_time = await asyncio.to_thread(self._disk.get, key, expire_time=True)
+            remaining = expire_time - time.time() if expire_time is not None else CACHE_TTL
+            return value, remaining
+        return None, 0
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._memory_get(key)
+        if value is None:
+            try:
+                value, remaining = await self._backing_get(key)
+            except Exception:
+                logger.exception("Error membaca cache; dianggap miss")
+                value = None
+            if value is not None and remaining > 0:
+                # Salinan di memori tidak boleh hidup lebih lama dari aslinya
+                self._memory_set(key, value, remaining)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: Dict[str, Any], ttl: int = CACHE_TTL) -> None:
+        self._memory_set(key, value, ttl)
+        try:
+            if self._redis is not None:
+                await self._redis.set(key, json.dumps(value), ex=ttl)
+            elif self._disk is not None:
+                await asyncio.to_thread(self._disk.set, key, value, expire=ttl)
+        except Exception:
+            logger.exception("Error menulis cache")
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        if self._redis is not None:
+            backend = "redis"
+        elif self._disk is not None:
+            backend = "disk"
+        else:
+            backend = "memory"
+        return {
+            "backend": backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+cache = LLMCache()
+
+# Single-flight: permintaan identik yang sedang berjalan bersamaan berbagi satu
+# Future, sehingga N duplikat hanya menghasilkan satu panggilan ke API.
+# Cek-dan-isi dict tidak mengandung `await`, jadi sudah atomik di event loop.
+inflight: Dict[str, asyncio.Future] = {}
+
+class InflightCancelled(Exception):
+    """Pemimpin single-flight dibatalkan; penunggu harus memanggil ulang sendiri."""
+
+def _finish_inflight(key: str, future: asyncio.Future, error: Optional[BaseException] = None) -> None:
+    """Lepas key dari map; jika pemimpin gagal/dibatalkan, teruskan error ke penunggu."""
+    inflight.pop(key, None)
+    if not future.done():
+        if not isinstance(error, Exception):
+            error = InflightCancelled("Permintaan yang sama dibatalkan.")
+        future.set_exception(error)
+        future.exception() # Tandai sudah dibaca agar asyncio tidak mencetak peringatan
+
+# --- 6. Cache Semantik (kemiripan embedding) ---
+# Prompt yang maknanya sama ("ibu kota Prancis" vs "Prancis ibu kotanya apa")
+# memakai ulang jawaban konsensus sebelumnya, sehingga semua panggilan
+# model + konsensus dilewati. Butuh `pip install numpy`.
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_INDEX_PATH = os.environ.get("SEMANTIC_CACHE_PATH", "semantic_cache.npz")
+SEMANTIC_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError: # Windows: tanpa lock, penyimpanan bersamaan bisa saling menimpa
+    fcntl = None
+
+@contextmanager
+def _file_lock(path: str):
+    """Lock eksklusif antar proses (flock) selama blok berjalan."""
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+class SemanticCache:
+    """
+    Matriks embedding prompt (N x D, float32, ternormalisasi L2) + daftar respons
+    konsensus yang sejajar. Satu lookup = satu perkalian matriks-vektor (BLAS
+    sgemv) atas seluruh isi cache, bukan loop Python per baris.
+
+    Setiap entri dicatat bersama kombinasi model yang menghasilkannya; lookup
+    hanya mencocokkan entri dengan kombinasi model yang sama.
+
+    Jumlah entri dibatasi `max_entries`; setelah penuh, buffer dipakai sebagai
+    ring dan entri tertua ditimpa (FIFO) tanpa menggeser matriks.
+    """
+
+    def __init__(self, path: str, max_entries: int = SEMANTIC_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.embeddings = None # Buffer dengan kapasitas >= jumlah entri
+        self.groups = None # Id kombinasi model per baris, sejajar dengan embeddings
+        self.size = 0
+        self.responses: List[Dict[str, Any]] = []
+        self._oldest = 0 # Baris yang ditimpa berikutnya saat cache penuh
+        # Entri yang ditambahkan proses ini sejak dimuat, untuk digabung saat save()
+        self._pending: "deque[Tuple[Any, Dict[str, Any]]]" = deque(maxlen=max_entries)
+        self._group_ids: Dict[str, int] = {}
+        self.enabled = np is not None
+
+    @staticmethod
+    def models_key(models: List[str]) -> str:
+        return ",".join(sorted(set(models)))
+
+    def _group_id(self, models_key: str) -> int:
+        return self._group_ids.setdefault(models_key, len(self._group_ids))
+
+    def _read_file(self) -> Optional[Tuple[Any, List[Dict[str, Any]]]]:
+        """Isi file cache (embedding, respons), atau None jika tidak ada/tidak valid."""
+        if not os.path.exists(self.path):
+            return None
+        with np.load(self.path) as data:
+            embeddings = data["embeddings"]
+            responses = json.loads(str(data["responses"]))
+        # Baris ke-i harus milik respons ke-i; file yang tidak sejajar ditolak
+        if embeddings.ndim != 2 or len(embeddings) != len(responses):
+            logger.warning(
+                "Peringatan: Cache semantik tidak konsisten (%d embedding, %d respons), diabaikan.",
+                len(embeddings), len(responses),
+            )
+            return None
+        return embeddings.astype(np.float32), responses
+
+    def load(self) -> None:
+        if not self.enabled:
+            return
+        try:
+            stored = self._read_file()
+            if stored is None:
+                return
+            embeddings, responses = stored
+            # File bisa lebih besar dari batas (mis. batas diturunkan): simpan yang terbaru
+            self.embeddings = embeddings[-self.max_entries:]
+            self.responses = responses[-self.max_entries:]
+            self.groups = np.asarray(
+                [self._group_id(r.get("models", "")) for r in self.responses], dtype=np.int32
+            )
+            self.size = len(self.responses)
+        except Exception:
+            logger.exception("Peringatan: Gagal memuat cache semantik.")
+            self.embeddings, self.groups, self.size, self.responses = None, None, 0, []
+
+    def save(self) -> None:
+        """
+        Menggabungkan entri baru proses ini ke file yang sudah ada di disk.
+
+        Setiap worker uvicorn memuat file yang sama lalu menambah entrinya
+        sendiri, jadi menimpa file dengan isi memori akan menghapus entri worker
+        lain. Di bawah lock file, isi disk dibaca ulang, entri baru ditambahkan
+        di belakang (dipotong ke `max_entries` terbaru), lalu hasilnya ditulis ke
+        file sementara dan di-`os.replace` agar pembaca tidak melihat file setengah jadi.
+        """
+        if not self.enabled or not self._pending:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with _file_lock(self.path + ".lock"):
+                stored = self._read_file()
+                embeddings, responses = stored if stored is not None else (None, [])
+                new_embeddings = np.stack([vec for vec, _ in self._pending])
+                if embeddings is not None and embeddings.shape[1] == new_embeddings.shape[1]:
+                    new_embeddings = np.concatenate([embeddings, new_embeddings])
+                else:
+                    responses = []
+                responses = responses + [entry for _, entry in self._pending]
+                with open(tmp_path, "wb") as f:
+                    np.savez(
+                        f,
+                        embeddings=new_embeddings[-self.max_entries:],
+                        responses=np.array(json.dumps(responses[-self.max_entries:])),
+                    )
+                os.replace(tmp_path, self.path)
+            self._pending.clear()
+        except Exception:
+            logger.exception("Peringatan: Gagal menyimpan cache semantik.")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def embed(self, prompt: str):
+        """Embedding prompt (dinormalisasi L2 agar inner product = cosine)."""
+        key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        cached = await embedding_cache.get(key)
+        if cached is not None:
+            return cached["embedding"]
+        async with OPENAI_SEM:
+            result = await get_openai_client().embeddings.create(
+                model=EMBEDDING_MODEL, input=prompt
+            )
+        vec = np.asarray(result.data[0].embedding, dtype=np.float32)
+        vec /= np.linalg.norm(vec)
+        await embedding_cache.set(key, {"embedding": vec})
+        return vec
+
+    def lookup(self, vec, models: List[str]) -> Optional[Dict[str, Any]]:
+        group = self._group_ids.get(self.models_key(models))
+        if self.size == 0 or group is None:
+            return None
+        sims = self.embeddings[:self.size] @ vec
+        sims[self.groups[:self.size] != group] = -np.inf
+        idx = int(sims.argmax())
+        if sims[idx] >= SEMANTIC_THRESHOLD:
+            return self.responses[idx]
+        return None
+
+    def add(self, vec, models: List[str], response: Dict[str, Any]) -> None:
+        key = self.models_key(models)
+        entry = {"models": key, **response}
+        if self.size >= self.max_entries:
+            # Penuh: timpa entri tertua
+            row = self._oldest
+            self._oldest = (self._oldest + 1) % self.size
+            self.responses[row] = entry
+        else:
+            # Kapasitas digandakan saat penuh agar penambahan tidak menyalin matriks setiap kali
+            if self.embeddings is None:
+                capacity = min(64, self.max_entries)
+                self.embeddings = np.empty((capacity, vec.shape[0]), dtype=np.float32)
+                self.groups = np.empty(capacity, dtype=np.int32)
+            elif self.size == len(self.embeddings):
+                capacity = min(2 * self.size, self.max_entries)
+                grown = np.empty((capacity, vec.shape[0]), dtype=np.float32)
+                grown[:self.size] = self.embeddings[:self.size]
+                self.embeddings = grown
+                self.groups = np.resize(self.groups, capacity)
+            row = self.size
+            self.size += 1
+            self.responses.append(entry)
+        self.embeddings[row] = vec
+        self.groups[row] = self._group_id(key)
+        self._pending.append((vec, entry))
+
+semantic_cache = SemanticCache(SEMANTIC_INDEX_PATH)
+# Memo embedding per prompt (LRU memori, dibatasi LLM_CACHE_MEMORY_SIZE): prompt
+# yang diulang tidak menunggu panggilan embedding OpenAI lagi
+embedding_cache = LLMCache()
+
+# --- 7. Fungsi Helper Pemanggil LLM ---
 async def call_llm(model_name: str, prompt: str) -> ModelResponse:
+    """Memanggil LLM yang dipilih, memakai cache jika prompt yang sama pernah dijawab."""
+    key = LLMCache.make_key(model_name, prompt)
+    cached = await cache.get(key)
+    if cached is not None:
+        return ModelResponse(**cached)
+
+    # Prompt yang sama sedang diproses: tunggu hasilnya saja
+    while (future := inflight.get(key)) is not None:
+        try:
+            return await asyncio.shield(future)
+        except InflightCancelled:
+            continue # Pemimpin dibatalkan (mis. mode "fastest"); coba lagi
+
+    future = inflight[key] = asyncio.get_running_loop().create_future()
+    error = None
+    try:
+        result = await _call_llm_uncached(model_name, prompt)
+        # Hanya simpan respons yang berhasil; error tidak boleh ikut di-cache
+        if "Gagal mendapatkan respons" not in result.response and model_name in ("gemini", "gpt"):
+            await cache.set(key, result.model_dump(), ttl=CACHE_TTL)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _finish_inflight(key, future, error)
+
+async def _call_llm_uncached(model_name: str, prompt: str) -> ModelResponse:
     """Memanggil LLM yang dipilih secara asynchronous."""
     try:
         if model_name == "gemini":
-            response = await asyncio.to_thread(gemini_model.generate_content, prompt)
+            async with GEMINI_SEM:
+                response = await get_gemini_client().aio.models.generate_content(
+                    model=GEMINI_MODEL, contents=prompt
+                )
             return ModelResponse(model_name="Gemini", response=response.text)
         
         elif model_name == "gpt":
-            response = await asyncio.to_thread(
-                openai_client.chat.completions.create,
-                model="gpt-3.5-turbo", # atau "gpt-4"
-                messages=[{"role": "user", "content": prompt}]
-            )
+            async with OPENAI_SEM:
+                response = await get_openai_client().chat.completions.create(
+                    model="gpt-3.5-turbo", # atau "gpt-4"
+                    messages=[{"role": "user", "content": prompt}]
+                )
             return ModelResponse(model_name="GPT (OpenAI)", response=response.choices[0].message.content)
         
         else:
             return ModelResponse(model_name=model_name, response="Model tidak dikenal.")
             
     except Exception as e:
-        print(f"Error memanggil {model_name}: {e}")
+        logger.exception("Error memanggil %s", model_name)
         return ModelResponse(model_name=model_name, response=f"Gagal mendapatkan respons: {e}")
 
-# --- 6. Fungsi Logika Konsensus ---
-async def generate_consensus(prompt: str, responses: List[ModelResponse]) -> str:
-    """Menghasilkan ringkasan konsensus dari berbagai respons LLM."""
-    
-    # Jika hanya satu respons atau terjadi error, kembalikan respons pertama
-    if len(responses) == 1:
-        return responses[0].response
+# --- 8. Fungsi Logika Konsensus ---
+async def generate_consensus(prompt: str, responses: List[ModelResponse]) -> AsyncIterator[str]:
+    """Menghasilkan konsensus secara streaming; duplikat yang bersamaan berbagi satu panggilan."""
+    # Jika hanya satu respons, atau semua model menjawab sama persis, juri tidak
+    # diperlukan: kembalikan respons pertama tanpa panggilan LLM tambahan
+    if len({r.response.strip().lower() for r in responses}) == 1:
+        yield responses[0].response
+        return
+
+    combined_answers = "\n\n".join(f"{r.model_name}: {r.response}" for r in responses)
+    key = hashlib.sha256((prompt + combined_answers).encode("utf-8")).hexdigest()
 
-    # Buat prompt baru untuk AI konsensus
-    consensus_prompt = f"""
+    # Konsensus yang sama sedang di-stream ke klien lain: kirim hasil akhirnya sekaligus
+    while (future := inflight.get(key)) is not None:
+        try:
+            text = await asyncio.shield(future)
+        except InflightCancelled:
+            continue # Klien pemimpin memutus koneksi; coba lagi
+        yield text
+        return
+
+    future = inflight[key] = asyncio.get_running_loop().create_future()
+    parts: List[str] = []
+    error = None
+    try:
+        async for text in _stream_consensus(prompt, responses):
+            parts.append(text)
+            yield text
+        future.set_result("".join(parts))
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _finish_inflight(key, future, error)
+
+# Potongan statis template konsensus di-encode sekali saat import
+_TPL_HEAD = '''
     Tugas Anda adalah bertindak sebagai editor ahli.
     Anda telah menerima beberapa jawaban dari AI yang berbeda untuk pertanyaan awal pengguna.
     
-    Pertanyaan Pengguna: "{prompt}"
+    Pertanyaan Pengguna: "'''.encode("utf-8")
+_TPL_ANSWERS = '''"
 
     Berikut adalah jawaban-jawaban tersebut:
-    """
-    
-    for resp in responses:
-        consensus_prompt += f"\n--- Jawaban dari {resp.model_name} ---\n{resp.response}\n--- Akhir Jawaban ---\n"
-        
-    consensus_prompt += """
+    '''.encode("utf-8")
+_TPL_ANSWER_OPEN = "\n--- Jawaban dari ".encode("utf-8")
+_TPL_ANSWER_SEP = " ---\n".encode("utf-8")
+_TPL_ANSWER_CLOSE = "\n--- Akhir Jawaban ---\n".encode("utf-8")
+_TPL_TAIL = """
     Harap sintesiskan jawaban-jawaban ini menjadi satu jawaban akhir yang kohesif, akurat, dan komprehensif. 
     Ambil poin-poin terbaik dari setiap jawaban. Jangan hanya mendaftar apa yang dikatakan setiap AI.
     Tuliskan jawaban akhir seolah-olah Anda menjawab pertanyaan pengguna secara langsung.
-    """
+    """.encode("utf-8")
+
+LARGE_PROMPT_THRESHOLD = 64 * 1024 # Karakter; di atas ini prompt dirakit di thread
+
+def build_consensus_prompt(prompt: str, responses: List[ModelResponse]) -> str:
+    """Merakit prompt konsensus dengan satu b"".join lalu satu kali decode."""
+    parts = [_TPL_HEAD, prompt.encode("utf-8"), _TPL_ANSWERS]
+    for resp in responses:
+        parts += (
+            _TPL_ANSWER_OPEN, resp.model_name.encode("utf-8"), _TPL_ANSWER_SEP,
+            resp.response.encode("utf-8"), _TPL_ANSWER_CLOSE,
+        )
+    parts.append(_TPL_TAIL)
+    return b"".join(parts).decode("utf-8")
+
+async def _stream_consensus(prompt: str, responses: List[ModelResponse]) -> AsyncIterator[str]:
+    """Menghasilkan ringkasan konsensus secara streaming, potongan demi potongan."""
+
+    # Prompt konsensus besar dirakit di thread lain agar event loop tetap responsif
+    if sum(len(r.response) for r in responses) > LARGE_PROMPT_THRESHOLD:
+        consensus_prompt = await asyncio.to_thread(build_consensus_prompt, prompt, responses)
+    else:
+        consensus_prompt = build_consensus_prompt(prompt, responses)
     
+    # Menggunakan Gemini untuk membuat konsensus; token diteruskan begitu tiba.
+    # Slot semaphore dipegang selama stream berlangsung.
+    async with GEMINI_SEM:
+        stream = await get_gemini_client().aio.models.generate_content_stream(
+            model=GEMINI_MODEL, contents=consensus_prompt
+        )
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Format satu event Server-Sent Events (data dikirim sebagai JSON)."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def is_successful(response: ModelResponse) -> bool:
+    return "Gagal mendapatkan respons" not in response.response
+
+def jaccard_similarity(a: str, b: str) -> float:
+    """Kemiripan Jaccard antara himpunan token (kata) dua teks."""
+    tokens_a, tokens_b = set(a.lower().split()), set(b.lower().split())
+    if not tokens_a and not tokens_b:
+        return 1.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+def sse_single(text: str) -> Iterable[str]:
+    """Stream SSE berisi satu potongan teks utuh (hasil cache atau mode "fastest")."""
+    return iter([sse_event({"text": text}), sse_event({}, event="done")])
+
+async def first_successful(tasks: List[asyncio.Task]) -> Optional[ModelResponse]:
+    """Menunggu respons sukses pertama lalu membatalkan sisa task (termasuk request HTTP-nya)."""
+    pending = set(tasks)
     try:
-        # Menggunakan Gemini untuk membuat konsensus
-        consensus_response = await asyncio.to_thread(gemini_model.generate_content, consensus_prompt)
-        return consensus_response.text
-    except Exception as e:
-        print(f"Error saat membuat konsensus: {e}")
-        return f"Gagal membuat konsensus. Error: {e}"
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if is_successful(task.result()):
+                    return task.result()
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
 
-# --- 7. API Endpoint Utama ---
-@app.post("/api/aggregate", response_model=ModelResponse)
+def start_consensus(prompt: str, responses: List[ModelResponse]) -> Tuple[asyncio.Task, asyncio.Queue]:
+    """
+    Menjalankan konsensus sebagai background task yang menaruh potongan teks ke antrean.
+    Antrean diakhiri dengan None, atau berisi Exception jika konsensus gagal.
+    """
+    chunks: asyncio.Queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for text in generate_consensus(prompt, responses):
+                chunks.put_nowait(text)
+            chunks.put_nowait(None)
+        except Exception as e:
+            chunks.put_nowait(e)
+
+    return asyncio.create_task(pump()), chunks
+
+# --- 9. API Endpoint Utama ---
+@app.post("/api/aggregate")
 async def aggregate_responses(request: PromptRequest):
     """
     Menerima prompt, mengirimkannya ke beberapa LLM, 
-    dan mengembalikan konsensus.
+    dan men-stream konsensus sebagai Server-Sent Events.
+
+    Setiap event `data` berisi {"text": "..."}; stream ditutup dengan
+    event `done`, atau event `error` jika konsensus gagal di tengah jalan.
     """
     if not request.prompt:
         raise HTTPException(status_code=400, detail="Prompt tidak boleh kosong.")
+
+    # Cek cache semantik: prompt yang mirip cukup memakai konsensus sebelumnya
+    prompt_vec = None
+    if semantic_cache.enabled and not request.no_cache:
+        try:
+            prompt_vec = await semantic_cache.embed(request.prompt)
+            cached = semantic_cache.lookup(prompt_vec, request.models)
+            if cached is not None:
+                return StreamingResponse(sse_single(cached["response"]), media_type="text/event-stream")
+        except Exception:
+            logger.exception("Error cache semantik")
+            prompt_vec = None
         
     # Panggil semua model secara paralel
-    tasks = [call_llm(model_name, request.prompt) for model_name in request.models]
-    model_responses = await asyncio.gather(*tasks)
+    tasks = [asyncio.create_task(call_llm(model_name, request.prompt)) for model_name in request.models]
+
+    if request.mode == "fastest":
+        winner = await first_successful(tasks)
+        if winner is None:
+            raise HTTPException(status_code=500, detail="Semua model AI gagal merespons.")
+        return StreamingResponse(sse_single(winner.response), media_type="text/event-stream")
+
+    quorum = math.ceil(len(tasks) / 2)
+
+    # Eksekusi spekulatif: begitu separuh model selesai dan minimal dua di antaranya
+    # berhasil, konsensus langsung dimulai agar tumpang tindih dengan model yang
+    # lambat. Satu respons saja bukan konsensus, jadi tidak pernah dispekulasikan.
+    model_responses: List[ModelResponse] = []
+    speculative: Optional[Tuple[List[ModelResponse], asyncio.Task, asyncio.Queue]] = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            model_responses.append(await next_done)
+            partial = [r for r in model_responses if is_successful(r)]
+            if speculative is None and len(partial) >= 2 and quorum <= len(model_responses) < len(tasks):
+                speculative = (partial, *start_consensus(request.prompt, partial))
+    except BaseException:
+        # Salah satu model melempar error (mis. backend cache gagal): hentikan sisanya
+        for task in tasks:
+            task.cancel()
+        if speculative is not None:
+            speculative[1].cancel()
+        raise
     
     # Filter respons yang gagal
-    successful_responses = [r for r in model_responses if "Gagal mendapatkan respons" not in r.response]
+    successful_responses = [r for r in model_responses if is_successful(r)]
     
     if not successful_responses:
         raise HTTPException(status_code=500, detail="Semua model AI gagal merespons.")
-        
-    # Hasilkan konsensus
-    consensus_text = await generate_consensus(request.prompt, successful_responses)
-    
-    return ModelResponse(model_name="Konsensus", response=consensus_text)
 
-# --- 8. (Opsional) Endpoint Root ---
-@app.get("/")
+    consensus = None
+    if speculative is not None:
+        partial, task, chunks = speculative
+        late = [r for r in successful_responses if r not in partial]
+        # Jawaban yang datang belakangan jauh berbeda: konsensus spekulatif dibuang
+        if any(max(jaccard_similarity(r.response, p.response) for p in partial) < 0.5 for r in late):
+            task.cancel()
+        else:
+            consensus = (task, chunks)
+    if consensus is None:
+        consensus = start_consensus(request.prompt, successful_responses)
+
+    async def token_generator() -> AsyncIterator[str]:
+        task, chunks = consensus
+        parts: List[str] = []
+        try:
+            while (item := await chunks.get()) is not None:
+                if isinstance(item, Exception):
+                    logger.error("Error saat membuat konsensus", exc_info=item)
+                    yield sse_event({"detail": f"Gagal membuat konsensus. Error: {item}"}, event="error")
+                    return
+                parts.append(item)
+                yield sse_event({"text": item})
+        finally:
+            # Klien memutus koneksi di tengah stream: hentikan juga konsensusnya
+            task.cancel()
+
+        if prompt_vec is not None:
+            result = ModelResponse(model_name="Konsensus", response="".join(parts))
+            semantic_cache.add(prompt_vec, request.models, result.model_dump())
+        yield sse_event({}, event="done")
+
+    return StreamingResponse(token_generator(), media_type="text/event-stream")
+
+# --- 10. (Opsional) Endpoint Root ---
+@app.get("/", response_model=StatusResponse, response_model_exclude_none=True)
 def read_root():
-    return {"status": "AI Aggregator API sedang berjalan!"}
+    return StatusResponse(status="AI Aggregator API sedang berjalan!")
+
+# --- 11. Statistik Cache ---
+@app.get("/cache/stats", response_model=CacheStats, response_model_exclude_none=True)
+def cache_stats():
+    return CacheStats(**cache.stats())
+
+# --- 12. Skema dibangun sekali saat startup (dipanggil dari lifespan) ---
+def build_schemas():
+    """Bangun skema OpenAPI di awal, bukan saat permintaan pertama ke /docs."""
+    app.openapi() # Hasilnya disimpan di app.openapi_schema
+
+
+# --- 13. Menjalankan Server ---
+# uvloop (libuv) dan parser httptools jauh lebih cepat daripada event loop dan
+# parser HTTP bawaan Python. Mode "auto" memakai keduanya bila terpasang
+# (uvicorn[standard]) dan kembali ke asyncio/h11 bila tidak, mis. uvloop di Windows.
+# Setara dengan (WEB_CONCURRENCY dibaca uvicorn sebagai --workers dan dipakai
+# bagian 2 untuk membagi anggaran semaphore; jangan pakai --workers terpisah):
+#   WEB_CONCURRENCY=$(nproc) uvicorn main:app
+if __name__ == "__main__":
+    import uvicorn
 
+    # Diwariskan ke proses worker agar pembagian anggaran semaphore di atas tepat
+    os.environ.setdefault("WEB_CONCURRENCY", str(os.cpu_count() or 1))
+    uvicorn.run(
+        "main:app",
+        host=os.environ.get("HOST", "127.0.0.1"),
+        port=int(os.environ.get("PORT", "8000")),
+        loop="auto",
+        http="auto",
+        workers=int(os.environ["WEB_CONCURRENCY"]),
+    )
@@ -0,0 +1,372 @@
+# File: test_main.py
+# Tes untuk single-flight, pembatalan pemimpin, konsensus spekulatif, dan cache semantik.
+# Semua panggilan API di-stub, jadi tidak butuh kunci API maupun jaringan.
+
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def isolated_state(monkeypatch):
+    """Cache dan map single-flight baru untuk setiap tes."""
+    monkeypatch.setattr(main, "cache", main.LLMCache())
+    monkeypatch.setattr(main, "inflight", {})
+
+
+def stub_workers(monkeypatch, answers, delays):
+    """Ganti _call_llm_uncached dengan stub; kembalikan daftar model yang dipanggil."""
+    calls = []
+
+    async def fake_call(model_name, prompt):
+        calls.append(model_name)
+        await asyncio.sleep(delays.get(model_name, 0))
+        return main.ModelResponse(model_name=model_name, response=answers[model_name])
+
+    monkeypatch.setattr(main, "_call_llm_uncached", fake_call)
+    return calls
+
+
+def stub_consensus(monkeypatch):
+    """Ganti _stream_consensus dengan stub; kembalikan daftar input tiap panggilan."""
+    calls = []
+
+    async def fake_stream(prompt, responses):
+        names = [r.model_name for r in responses]
+        calls.append(names)
+        await asyncio.sleep(0.01)
+        yield "konsensus:" + ",".join(sorted(names))
+
+    monkeypatch.setattr(main, "_stream_consensus", fake_stream)
+    return calls
+
+
+async def read_stream(response):
+    return "".join([chunk async for chunk in response.body_iterator])
+
+
+def test_duplicate_prompts_share_one_call(monkeypatch):
+    calls = stub_workers(monkeypatch, {"gpt": "jawaban"}, {"gpt": 0.05})
+
+    async def run():
+        return await asyncio.gather(*[main.call_llm("gpt", "halo") for _ in range(5)])
+
+    results = asyncio.run(run())
+
+    assert calls == ["gpt"]
+    assert [r.response for r in results] == ["jawaban"] * 5
+    assert main.inflight == {}
+
+
+def test_follower_retries_when_leader_is_cancelled(monkeypatch):
+    calls = stub_workers(monkeypatch, {"gemini": "jawaban"}, {"gemini": 0.05})
+
+    async def run():
+        leader = asyncio.create_task(main.call_llm("gemini", "halo"))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(main.call_llm("gemini", "halo"))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    result = asyncio.run(run())
+
+    assert result.response == "jawaban"
+    assert calls == ["gemini", "gemini"]
+    assert main.inflight == {}
+
+
+def test_speculative_consensus_is_accepted_when_late_answer_agrees(monkeypatch):
+    stub_workers(
+        monkeypatch,
+        {
+            "a": "paris adalah ibu kota prancis",
+            "b": "ibu kota prancis adalah kota paris",
+            "c": "paris adalah ibu kota negara prancis",
+        },
+        {"a": 0, "b": 0.01, "c": 0.1},
+    )
+    consensus_calls = stub_consensus(monkeypatch)
+    request = main.PromptRequest(prompt="ibu kota prancis?", models=["a", "b", "c"], no_cache=True)
+
+    async def run():
+        return await read_stream(await main.aggregate_responses(request))
+
+    body = asyncio.run(run())
+
+    assert consensus_calls == [["a", "b"]]
+    assert "konsensus:a,b" in body
+
+
+def test_speculative_consensus_is_discarded_when_late_answer_differs(monkeypatch):
+    stub_workers(
+        monkeypatch,
+        {
+            "a": "paris adalah ibu kota prancis",
+            "b": "ibu kota prancis adalah kota paris",
+            "c": "lyon merupakan kota terbesar kedua",
+        },
+        {"a": 0, "b": 0.01, "c": 0.1},
+    )
+    consensus_calls = stub_consensus(monkeypatch)
+    request = main.PromptRequest(prompt="ibu kota prancis?", models=["a", "b", "c"], no_cache=True)
+
+    async def run():
+        return await read_stream(await main.aggregate_responses(request))
+
+    body = asyncio.run(run())
+
+    assert consensus_calls == [["a", "b"], ["a", "b", "c"]]
+    assert "konsensus:a,b,c" in body
+
+
+def test_two_workers_never_speculate_on_a_single_response(monkeypatch):
+    stub_workers(
+        monkeypatch,
+        {"gemini": "paris adalah ibu kota prancis", "gpt": "ibu kota prancis adalah paris"},
+        {"gemini": 0, "gpt": 0.05},
+    )
+    consensus_calls = stub_consensus(monkeypatch)
+    request = main.PromptRequest(prompt="ibu kota prancis?", no_cache=True)
+
+    async def run():
+        return await read_stream(await main.aggregate_responses(request))
+
+    body = asyncio.run(run())
+
+    assert consensus_calls == [["gemini", "gpt"]]
+    assert "konsensus:gemini,gpt" in body
+
+
+def test_semantic_cache_rejects_misaligned_file(tmp_path):
+    np = main.np
+    path = str(tmp_path / "semantic_cache.npz")
+    vec = np.full(4, 0.5, dtype=np.float32)
+
+    saved = main.SemanticCache(path)
+    saved.add(vec, ["gpt"], {"model_name": "Konsensus", "response": "jawaban"})
+    saved.save()
+    loaded = main.SemanticCache(path)
+    loaded.load()
+    assert loaded.lookup(vec, ["gpt"])["response"] == "jawaban"
+    assert loaded.lookup(vec, ["gemini", "gpt"]) is None
+
+    np.savez(path, embeddings=np.ones((2, 4), dtype=np.float32), responses=np.array("[]"))
+    misaligned = main.SemanticCache(path)
+    misaligned.load()
+    assert misaligned.size == 0
+
+
+def test_sse_stream_is_not_gzipped(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    long_answer = "jawaban " * 200 # Di atas minimum_size GZipMiddleware
+    stub_workers(monkeypatch, {"gpt": long_answer}, {})
+    client = TestClient(main.app)
+
+    response = client.post(
+        "/api/aggregate",
+        json={"prompt": "halo", "models": ["gpt"], "no_cache": True},
+        headers={"Accept-Encoding": "gzip"},
+    )
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert "content-encoding" not in response.headers
+
+
+def test_llm_cache_disk_tier_survives_restart_and_honours_ttl(tmp_path):
+    async def run():
+        first = main.LLMCache()
+        first.open(None, str(tmp_path))
+        await first.set("tetap", {"response": "a"}, ttl=60)
+        await first.set("kedaluwarsa", {"response": "b"}, ttl=0)
+        await first.close()
+
+        second = main.LLMCache()
+        second.open(None, str(tmp_path))
+        try:
+            return await second.get("tetap"), await second.get("kedaluwarsa"), second.stats()
+        finally:
+            await second.close()
+
+    kept, expired, stats = asyncio.run(run())
+
+    assert kept == {"response": "a"}
+    assert expired is None
+    assert stats["backend"] == "disk"
+
+
+def test_llm_cache_backend_failure_is_a_miss(tmp_path):
+    class BrokenDisk:
+        def get(self, *args, **kwargs):
+            raise OSError("disk penuh")
+
+        def set(self, *args, **kwargs):
+            raise OSError("disk penuh")
+
+    async def run():
+        cache = main.LLMCache()
+        cache._disk = BrokenDisk()
+        await cache.set("k", {"response": "a"})
+        cache._store.clear()
+        return await cache.get("k"), cache.stats()
+
+    value, stats = asyncio.run(run())
+
+    assert value is None
+    assert stats["misses"] == 1
+
+
+def test_semantic_cache_evicts_oldest_entry_when_full(tmp_path):
+    np = main.np
+    path = str(tmp_path / "semantic_cache.npz")
+    basis = np.eye(4, dtype=np.float32)
+
+    cache = main.SemanticCache(path, max_entries=3)
+    for i in range(4):
+        cache.add(basis[i], ["gpt"], {"model_name": "Konsensus", "response": str(i)})
+
+    assert cache.size == 3
+    assert cache.lookup(basis[0], ["gpt"]) is None
+    assert [cache.lookup(basis[i], ["gpt"])["response"] for i in (1, 2, 3)] == ["1", "2", "3"]
+
+    cache.save()
+    reloaded = main.SemanticCache(path, max_entries=3)
+    reloaded.load()
+    reloaded.add(basis[0], ["gpt"], {"model_name": "Konsensus", "response": "4"})
+    assert reloaded.lookup(basis[1], ["gpt"]) is None # Tertua setelah dimuat ulang
+    assert reloaded.lookup(basis[3], ["gpt"])["response"] == "3"
+
+
+def test_prompt_embedding_is_memoized(monkeypatch):
+    np = main.np
+    calls = []
+
+    class FakeEmbeddings:
+        async def create(self, model, input):
+            calls.append(input)
+            data = type("Item", (), {"embedding": [3.0, 4.0]})
+            return type("Result", (), {"data": [data]})
+
+    class FakeOpenAI:
+        embeddings = FakeEmbeddings()
+
+    monkeypatch.setattr(main, "get_openai_client", lambda: FakeOpenAI())
+    monkeypatch.setattr(main, "embedding_cache", main.LLMCache())
+    cache = main.SemanticCache("unused.npz")
+
+    async def run():
+        return await cache.embed("halo"), await cache.embed("halo")
+
+    first, second = asyncio.run(run())
+
+    assert calls == ["halo"]
+    assert np.allclose(first, [0.6, 0.8]) and np.allclose(second, first)
+
+
+def test_semantic_cache_save_merges_entries_from_other_workers(tmp_path):
+    np = main.np
+    path = str(tmp_path / "semantic_cache.npz")
+    basis = np.eye(4, dtype=np.float32)
+
+    seed = main.SemanticCache(path)
+    seed.add(basis[0], ["gpt"], {"model_name": "Konsensus", "response": "awal"})
+    seed.save()
+
+    # Dua worker memuat file yang sama, masing-masing menambah entri sendiri
+    workers = [main.SemanticCache(path), main.SemanticCache(path)]
+    for i, worker in enumerate(workers, start=1):
+        worker.load()
+        worker.add(basis[i], ["gpt"], {"model_name": "Konsensus", "response": f"worker{i}"})
+    for worker in workers:
+        worker.save()
+
+    merged = main.SemanticCache(path)
+    merged.load()
+    assert [r["response"] for r in merged.responses] == ["awal", "worker1", "worker2"]
+
+
+def test_fastest_mode_skips_failures_and_returns_first_success(monkeypatch):
+    calls = stub_workers(
+        monkeypatch,
+        {"a": "Gagal mendapatkan respons: timeout", "b": "jawaban cepat", "c": "jawaban lambat"},
+        {"a": 0, "b": 0.02, "c": 0.5},
+    )
+    consensus_calls = stub_consensus(monkeypatch)
+    request = main.PromptRequest(prompt="halo", models=["a", "b", "c"], mode="fastest", no_cache=True)
+
+    async def run():
+        body = await read_stream(await main.aggregate_responses(request))
+        await asyncio.sleep(0) # Biarkan task yang dibatalkan menyelesaikan `finally`
+        return body
+
+    body = asyncio.run(run())
+
+    assert "jawaban cepat" in body and "jawaban lambat" not in body
+    assert sorted(calls) == ["a", "b", "c"]
+    assert consensus_calls == []
+    assert main.inflight == {}
+
+
+def test_fastest_mode_returns_500_when_all_workers_fail(monkeypatch):
+    stub_workers(
+        monkeypatch,
+        {"gemini": "Gagal mendapatkan respons: x", "gpt": "Gagal mendapatkan respons: y"},
+        {"gpt": 0.01},
+    )
+    request = main.PromptRequest(prompt="halo", mode="fastest", no_cache=True)
+
+    with pytest.raises(main.HTTPException) as excinfo:
+        asyncio.run(main.aggregate_responses(request))
+
+    assert excinfo.value.status_code == 500
+    assert main.inflight == {}
+
+
+def test_consensus_duplicate_survives_fastest_cancelling_shared_leader(monkeypatch):
+    calls = stub_workers(
+        monkeypatch,
+        {"gemini": "paris ibu kota prancis", "gpt": "ibu kota prancis adalah paris"},
+        {"gemini": 0.1, "gpt": 0.01},
+    )
+    consensus_calls = stub_consensus(monkeypatch)
+    fastest = main.PromptRequest(prompt="halo", mode="fastest", no_cache=True)
+    consensus = main.PromptRequest(prompt="halo", no_cache=True)
+
+    async def run():
+        fast_task = asyncio.create_task(main.aggregate_responses(fastest))
+        await asyncio.sleep(0) # Permintaan "fastest" menjadi pemimpin kedua panggilan
+        slow_task = asyncio.create_task(main.aggregate_responses(consensus))
+        fast_body = await read_stream(await fast_task)
+        slow_body = await read_stream(await slow_task)
+        return fast_body, slow_body
+
+    fast_body, slow_body = asyncio.run(run())
+
+    assert "ibu kota prancis adalah paris" in fast_body
+    # Panggilan gemini milik pemimpin dibatalkan, jadi penunggunya memanggil ulang
+    assert sorted(calls) == ["gemini", "gemini", "gpt"]
+    assert [sorted(names) for names in consensus_calls] == [["gemini", "gpt"]]
+    assert "konsensus:gemini,gpt" in slow_body
+    assert main.inflight == {}
+
+
+def test_lifespan_restart_rebuilds_clients_on_fresh_pool(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(main, "GEMINI_API_KEY", "kunci-uji")
+    monkeypatch.setattr(main, "OPENAI_API_KEY", "kunci-uji")
+    monkeypatch.setattr(main, "DISK_CACHE_DIR", str(tmp_path / "llm_cache"))
+    monkeypatch.setattr(main, "semantic_cache", main.SemanticCache(str(tmp_path / "semantic.npz")))
+    for factory in (main.get_http_client, main.get_gemini_client, main.get_openai_client):
+        factory.cache_clear()
+
+    for _ in range(2):
+        with TestClient(main.app):
+            pool = main.get_http_client()
+            assert not pool.is_closed
+            assert main.get_gemini_client()._api_client._async_httpx_client is pool
+            assert main.get_openai_client()._client is pool
+        assert pool.is_closed